@@ -1,19 +1,49 @@
 import csv
 import argparse
+import asyncio
+import math
 import os
+import random
+import time
 import traceback
-import pathlib
-from typing import Dict, List, Tuple
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+import requests
+from urllib3.util.retry import Retry
 from azure.storage.blob import BlobServiceClient, ContainerClient
 from azure.core.exceptions import ResourceNotFoundError, HttpResponseError
+from azure.core.pipeline.transport import RequestsTransport
 
 # environment variable to retrieve key for Azure Storage access from if none is provided
 ENV_KEY = "AZURE_STORAGE_CONNECTION_STRING"
 
 log = print
+SILENT = False
 DRY = False
 RENAME = True
 
+# max seconds to wait between retries, also when azure asks for longer with Retry-After
+RETRY_MAX_WAIT = 60
+
+def positive_int(value: str) -> int:
+    "argparse type for options that need a number of at least 1"
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+def split_ext(fname: str) -> Tuple[str, str]:
+    """
+    Split a filename into name and extension, same as os.path.splitext on a filename without folders
+
+    Leading dots belong to the name, so '.bashrc' and '..foo' have no extension
+    """
+    idx = fname.rfind('.')
+    if idx > 0 and fname[:idx].lstrip('.'):
+        return fname[:idx], fname[idx:]
+    return fname, ''
+
 parser = argparse.ArgumentParser(description='Download files hosted on Azure Storage')
 parser.add_argument('paths', nargs='*', help='path on azure storage to download')
 parser.add_argument('-p', '--path', action='append', help='path on azure storage to download, can be repeated')
@@ -26,38 +56,112 @@ parser.add_argument('--dry', action="store_true", help='perform a dry run where
 parser.add_argument('--no-rename', action="store_true", help="don't rename the filename if it already exists in output folder (file will just be skipped)")
 parser.add_argument('--silent', action="store_true", help='only print errors')
 parser.add_argument('--delimiter', default=',', help="excel may use ';' as delimiter, you can change that here")
+parser.add_argument('--concurrency', type=positive_int, default=32, help="number of files to download in parallel")
+parser.add_argument('--blob-concurrency', type=positive_int, default=4, help="number of connections used to download each file, large files are fetched in parallel chunks")
+parser.add_argument('--retries', type=int, default=4, help="number of times to retry a download that azure throttled")
+parser.add_argument('--async', dest='use_async', action="store_true", help="download using asyncio instead of threads, scales better for many small files (requires aiohttp)")
+
+
+class _OutputFile:
+    """
+    The file a blob is downloaded to, closed again when used as a context manager
+    and removed if the download didn't complete
+
+    `file` stays None until it is created by AzureDownloader._open_output, and on a dry run
+    """
+
+    def __init__(self, fpath: str, path: str) -> None:
+        self.fpath = fpath
+        self.path = path
+        self.file = None
+        self.complete = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.file is None:
+            return
+        self.file.close()
+        if not self.complete:
+            # don't leave a partly written file behind that could be taken for a complete download
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
 
+    def reset(self):
+        "Discard what a failed attempt wrote before retrying"
+        if self.file is not None:
+            self.file.seek(0)
+            self.file.truncate()
 
-class AzureDownloader:
+    def ok(self):
+        "Result for a completed download"
+        self.complete = True
+        return self.fpath, "ok", self.path
 
-    blob_service_client: BlobServiceClient = None
-    container_clients: Dict[str, ContainerClient] = {}
+    def skipped(self):
+        "Result for a download skipped because the file already exists and renaming isn't allowed"
+        return self.fpath, "skipped", f"file already exists: '{self.path}'"
 
-    def __init__(self, key: str, transform = False) -> None:
+
+class AzureDownloader:
+
+    def __init__(self, key: str, transform = False, concurrency = 32, blob_concurrency = 4, retries = 4) -> None:
         self.key = key
         self.transform = transform
+        self.concurrency = concurrency
+        self.blob_concurrency = blob_concurrency
+        self.retries = retries
         self._fetched_paths = []
 
+        # clients are created lazily per instance, so instances with different keys don't share them
+        self.blob_service_client: Optional[BlobServiceClient] = None
+        self.container_clients: Dict[str, ContainerClient] = {}
+        # guards creation of the clients above when downloading in parallel
+        self._client_lock = threading.Lock()
+
+    @property
+    def connection_pool_size(self):
+        "Number of connections needed to keep every file and every chunk of it downloading at once"
+        return self.concurrency * self.blob_concurrency
+
+    def _create_transport(self):
+        """
+        Create the http transport for the BlobServiceClient
+
+        requests keeps at most 10 connections per host by default, which would throttle the parallel downloads
+        """
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=self.connection_pool_size,
+            # retries are handled by the azure pipeline
+            max_retries=Retry(total=False, redirect=False, raise_on_status=False),
+        )
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return RequestsTransport(session=session)
+
     def create(self, path):
         "Create the output folder if it doesnt already exist"
-        if not DRY and not os.path.isdir(path):
-            os.mkdir(path)
+        if not DRY:
+            os.makedirs(path, exist_ok=True)
 
     def get_container_client(self, name: str):
         if not self.key:
             raise SystemExit("ERROR: no connection key to access azure storage provided")
-        
-        cls = AzureDownloader
 
-        if not cls.blob_service_client:
-            # Instantiate a BlobServiceClient using a connection string
-            cls.blob_service_client = BlobServiceClient.from_connection_string(self.key)
+        with self._client_lock:
+            if not self.blob_service_client:
+                # Instantiate a BlobServiceClient using a connection string
+                self.blob_service_client = BlobServiceClient.from_connection_string(self.key, transport=self._create_transport())
 
-        if name not in self.container_clients:
-            # Instantiate a ContainerClient
-            self.container_clients[name] = cls.blob_service_client.get_container_client(name)
+            if name not in self.container_clients:
+                # Instantiate a ContainerClient
+                self.container_clients[name] = self.blob_service_client.get_container_client(name)
 
-        return self.container_clients[name]
+            return self.container_clients[name]
 
     def _transform_paths(self, paths):
         "transform and normalize file paths so they fit what Azure expects"
@@ -66,127 +170,401 @@ class AzureDownloader:
         azure_paths = []
 
         for f in paths:
-            fparts = list(pathlib.Path(f).parts)
-            
-            for i, name in enumerate(fparts.copy()):
-                if name == 'OriginalFiler':
-                    fparts[i] = 'OriginalFiles'
-
-            ap = os.path.join(*fparts)
             # i think azure only accepts forward slashes
-            ap = ap.replace('\\', '/')
+            f = f.replace('\\', '/')
+            # empty and '.' parts are dropped, so duplicate slashes are collapsed like pathlib does
+            ap = '/'.join(
+                'OriginalFiles' if part == 'OriginalFiler' else part
+                for part in f.split('/') if part and part != '.'
+            )
+            if f.startswith('/'):
+                ap = '/' + ap
 
             azure_paths.append(ap)
         return azure_paths
 
-    def get_output_path(self, fpath: str, output_dir: str):
+    def get_output_path(self, fpath: str, output_dir: str, existing: Set[str]):
         """
         Return the path to save file to and whether it was renamed
+
+        `fpath` should already be normalized to forward slashes. `existing` holds the (normcased) filenames
+        already in output_dir. Files of this batch with the same name are told apart when they are created,
+        see _create_output_file
         """
-        # get filename
-        fname = os.path.split(fpath)[1]
-        opath = os.path.join(output_dir, fname)
+        # get filename, plain string operations as this runs for every file
+        fname = fpath.rsplit('/', 1)[-1]
+        oname = fname
         
         # rename path if it already exists
         rename_count = 0
-        while os.path.exists(opath):
-            rename_count += 1
-            p, ext = os.path.splitext(fname)
-            opath = os.path.join(output_dir, p+'_'+str(rename_count)+ext)
+        if os.path.normcase(oname) in existing:
+            p, ext = split_ext(fname)
+            while os.path.normcase(oname) in existing:
+                rename_count += 1
+                oname = p+'_'+str(rename_count)+ext
 
-        return opath, rename_count > 0
-        
+        return f"{output_dir}/{oname}", rename_count > 0
 
-    def download(self, output_dir: str, filepaths: List[str], container_name: str = None):
+    def _create_output_file(self, output_path: str, fpath: str):
         """
-        Download example files from Azure Storage into this format folder
+        Create and open output_path for writing, never overwriting an existing file
+
+        The existence check and creation happen in one call (O_EXCL), if the name is taken (by another
+        file of this batch, or since the output folder was listed) the next free name for fpath is used
+        instead, or None is returned if renaming isn't allowed.
+        Returns the opened file (or None) and the path it was created at
         """
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+        # output paths are built as f"{output_dir}/{filename}" by get_output_path, renamed files
+        # are numbered from the original filename the same way
+        output_dir = output_path.rpartition('/')[0]
+        p, ext = split_ext(fpath.replace('\\', '/').rsplit('/', 1)[-1])
+        opath = output_path
 
-        if self.transform:
-            filepaths = self._transform_paths(filepaths)
+        rename_count = 0
+        while True:
+            try:
+                fd = os.open(opath, flags, 0o644)
+            except FileExistsError:
+                if not RENAME:
+                    return None, opath
+                rename_count += 1
+                opath = f"{output_dir}/{p}_{rename_count}{ext}"
+                continue
+            return os.fdopen(fd, 'wb'), opath
+
+    def _open_output(self, output: _OutputFile) -> bool:
+        """
+        Create the file for output once its blob turned out to exist, so a missing blob never claims its name
 
-        default_container_name = container_name
+        Returns False if the file already exists and renaming isn't allowed
+        """
+        if DRY or output.file is not None:
+            # nothing to create, or already created by an earlier attempt
+            return True
+
+        # readinto writes the downloaded chunks straight to the file, chunks are far larger than
+        # the write buffer so they bypass it, and unlike a raw (buffering=0) file the buffered
+        # writer retries short writes which the sdk doesn't check for
+        f, path = self._create_output_file(output.path, output.fpath)
+        if f is None:
+            return False
+        output.file, output.path = f, path
+        return True
+
+    def _retry_delay(self, error: HttpResponseError, attempt: int) -> Optional[float]:
+        """
+        Return the seconds to wait before retrying a download that azure throttled, or None if it shouldn't be retried
 
-        log(f"Downloading {len(filepaths)} file paths from Azure Storage...")
+        The sdk's retry policy already retries timeouts and server errors, but it doesn't retry 429 and ignores
+        Retry-After. So only 429, and a 503 that asks to be retried with Retry-After, are retried here
+        """
+        if attempt >= self.retries:
+            return None
 
-        # create folder if it doesnt already exist
-        self.create(output_dir)
+        retry_after = None
+        if error.response is not None:
+            try:
+                retry_after = float(error.response.headers.get('Retry-After'))
+            except (TypeError, ValueError):
+                # not present or given as a date
+                pass
+            if retry_after is not None:
+                if math.isfinite(retry_after) and retry_after >= 0:
+                    retry_after = min(retry_after, RETRY_MAX_WAIT)
+                else:
+                    # a negative, nan or infinite wait is as good as none
+                    retry_after = None
+
+        if error.status_code == 503:
+            return retry_after
+        if error.status_code != 429:
+            return None
+        if retry_after is not None:
+            return retry_after
+
+        # exponential backoff with jitter, so throttled workers don't all retry at once
+        return min(RETRY_MAX_WAIT, 2 ** attempt + random.uniform(0, 1))
+
+    def _on_download_error(self, error: HttpResponseError, attempt: int, output: _OutputFile, container_name: str, tpath: str):
+        """
+        Handle an error from downloading a blob, shared by _download_one and _download_one_async
 
-        download_count = 0
+        Returns (None, seconds to wait) if the download should be retried, otherwise (failed result, None)
+        """
+        fpath = output.fpath
 
-        # paths that fail to download
-        fail_paths: List[Tuple[str, str]] = []
-        # paths that were renamed
-        renamed_paths: List[Tuple[str, str]] = []
+        if isinstance(error, ResourceNotFoundError):
+            return (fpath, "failed", f"blob does not exist on container ({container_name}): '{tpath}'"), None
+
+        delay = self._retry_delay(error, attempt)
+        if delay is None:
+            return (fpath, "failed", f"error when downloading blob on container ({container_name}) --\n\t{str(error)}: '{tpath}'"), None
+
+        # the error may have come partway through the blob, start the file over
+        output.reset()
+        return None, delay
+
+    def _download_one(self, container_client: ContainerClient, fpath: str, tpath: str, output_path: str):
+        """
+        Download a single blob from container_client to output_path
+
+        Returns (fpath, status, output_path) on success and (fpath, status, error message) otherwise,
+        the returned output_path differs from the given one if the file had to be renamed
+        """
+        container_name = container_client.container_name
+
+        with _OutputFile(fpath, output_path) as output:
+            attempt = 0
+            while True:
+                # the whole blob is retried, as the ranged requests made by readinto can be throttled too
+                try:
+                    # download file, blobs larger than a single chunk are fetched over several connections
+                    stream = container_client.download_blob(tpath, max_concurrency=self.blob_concurrency)
+                    if not self._open_output(output):
+                        return output.skipped()
+                    if output.file:
+                        stream.readinto(output.file)
+                    return output.ok()
+                except HttpResponseError as e:
+                    result, delay = self._on_download_error(e, attempt, output, container_name, tpath)
+                    if result:
+                        return result
+                time.sleep(delay)
+                attempt += 1
+
+
+    def _plan(self, output_dir: str, filepaths: List[str], container_name: str = None):
+        """
+        Resolve the container, blob path and output path of every file to download
+
+        Returns a list of (fpath, tpath, container name, output path, renamed)
+        """
+        default_container_name = container_name
+
+        # filenames already in the output folder, listed once instead of checking every candidate name on disk.
+        # Names shared within the batch are resolved when the files are created, so that a blob that fails
+        # to download doesn't claim its name (see _create_output_file)
+        existing: Set[str] = set()
+        if os.path.isdir(output_dir):
+            existing = {os.path.normcase(name) for name in os.listdir(output_dir)}
+
+        jobs: List[Tuple[str, str, str, str, bool]] = []
 
         for fpath in filepaths:
             
             # i think azure only accepts forward slashes
             tpath = fpath.replace('\\', '/')
 
-            try:
-                
-                output_path, renamed = self.get_output_path(fpath, output_dir)
-                if renamed:
-                    # if rename is not allowed, skip this file
-                    if not RENAME:
-                        continue
+            output_path, renamed = self.get_output_path(tpath, output_dir, existing)
+            if renamed:
+                # already in the output folder, if rename is not allowed skip this file
+                if not RENAME:
+                    continue
 
-                if not default_container_name:
-                    # get container name from path
-                    container_name, *rest = tpath.split('/')
-                    tpath = os.path.join("", *rest).replace('\\', '/')
+            if not default_container_name:
+                # get container name from path
+                container_name, _, tpath = tpath.partition('/')
 
+            jobs.append((fpath, tpath, container_name, output_path, renamed))
 
-                container_client = self.get_container_client(container_name)
+        return jobs
 
-                try:
-                    # download file
-                    stream = container_client.download_blob(tpath)
-                except ResourceNotFoundError:
-                    fail_paths.append((tpath, container_name))
-                    print(f"WARN blob does not exist on container ({container_name}): '{tpath}'")
-                    continue
-                except HttpResponseError as e:
-                    fail_paths.append((tpath, container_name))
-                    print(f"WARN error when downloading blob on container ({container_name}) --\n\t{str(e)}: '{tpath}'")
-                    continue
+    def _merge_results(self, jobs, results):
+        """
+        Collect the results of the downloaded jobs and log a summary
 
-                if not DRY:
-                    with open(output_path, 'wb') as f:
-                        for chunk in stream.chunks():
-                            f.write(chunk)
+        `results` yields the (fpath, status, detail) of each job in order, raising if its download raised
+        """
+        download_count = 0
+
+        # paths that fail to download
+        fail_paths: List[Tuple[str, str]] = []
+        # paths that were renamed
+        renamed_paths: List[Tuple[str, str]] = []
 
-                if renamed:
-                    renamed_paths.append((fpath, output_path))
-                    
-                download_count += 1
-                self._fetched_paths.append(fpath)
+        results = iter(results)
+        for fpath, tpath, container_name, output_path, renamed in jobs:
+            try:
+                _, status, detail = next(results)
             except Exception as e:
                 log('')
                 traceback.print_exc()
                 raise SystemExit(f"ERROR: above error occurred when attempting to download the following file from container ({container_name})", fpath)
 
-        log(f"Downloaded {download_count} file paths")
+            if status == "skipped":
+                continue
+
+            if status != "ok":
+                fail_paths.append((tpath, container_name))
+                print(f"WARN {detail}")
+                continue
+
+            if renamed or detail != output_path:
+                renamed_paths.append((fpath, detail))
+                
+            download_count += 1
+            self._fetched_paths.append(fpath)
+
+        if SILENT:
+            # don't format a summary no one will see
+            return
+
+        # the summary can run to thousands of lines, so it is logged in one write
+        report = [f"Downloaded {download_count} file paths"]
 
         if fail_paths:
-            log(f"Failed to download one more paths - (container) path")
-            for p, c in fail_paths:
-                log(f"- ({c}) '{p}'")
+            report.append(f"Failed to download one more paths - (container) path")
+            report.extend(f"- ({c}) '{p}'" for p, c in fail_paths)
 
         if renamed_paths:
-            log(f"Renamed one or more files because the name already exists")
-            for a, b in renamed_paths:
-                log(f"- {a}\n\t-> {b}")
+            report.append(f"Renamed one or more files because the name already exists")
+            report.extend(f"- {a}\n\t-> {b}" for a, b in renamed_paths)
+
+        log("\n".join(report))
+
+    def _prepare(self, output_dir: str, filepaths: List[str], container_name: str = None):
+        """
+        Set up a download of filepaths into output_dir, shared by download and download_async
+
+        Returns the jobs to download, see _plan
+        """
+        if not self.key:
+            raise SystemExit("ERROR: no connection key to access azure storage provided")
+
+        if self.transform:
+            filepaths = self._transform_paths(filepaths)
+
+        log(f"Downloading {len(filepaths)} file paths from Azure Storage...")
+
+        # create folder if it doesnt already exist
+        self.create(output_dir)
+
+        # resolve names up front, the downloads themselves are done in parallel
+        return self._plan(output_dir, filepaths, container_name)
+
+    def download(self, output_dir: str, filepaths: List[str], container_name: str = None):
+        """
+        Download example files from Azure Storage into this format folder
+        """
+        jobs = self._prepare(output_dir, filepaths, container_name)
+
+        # resolve each container client once, rather than once per file
+        container_clients = {name: self.get_container_client(name) for name in {job[2] for job in jobs}}
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [
+                executor.submit(self._download_one, container_clients[c], fpath, tpath, output_path)
+                for fpath, tpath, c, output_path, _ in jobs
+            ]
+
+            # results are merged here in the main thread, in the order the paths were given
+            try:
+                self._merge_results(jobs, (future.result() for future in futures))
+            finally:
+                # don't start the remaining downloads if one of them raised
+                for future in futures:
+                    future.cancel()
+
+    async def _download_one_async(self, container_client, fpath: str, tpath: str, output_path: str):
+        """
+        Async version of _download_one, takes an azure.storage.blob.aio.ContainerClient
+        """
+        container_name = container_client.container_name
+
+        with _OutputFile(fpath, output_path) as output:
+            attempt = 0
+            while True:
+                try:
+                    stream = await container_client.download_blob(tpath, max_concurrency=self.blob_concurrency)
+                    if not self._open_output(output):
+                        return output.skipped()
+                    if output.file:
+                        # the chunks are written to the os page cache, which is quick enough to not block the event loop noticeably
+                        await stream.readinto(output.file)
+                    return output.ok()
+                except HttpResponseError as e:
+                    result, delay = self._on_download_error(e, attempt, output, container_name, tpath)
+                    if result:
+                        return result
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def download_async(self, output_dir: str, filepaths: List[str], container_name: str = None):
+        """
+        Same as download, but all downloads share a single event loop instead of a thread each,
+        which scales better for many small files. Requires aiohttp
+        """
+        try:
+            import aiohttp
+        except ImportError:
+            raise SystemExit("ERROR: downloading with --async requires aiohttp (pip install aiohttp)")
+        from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+        from azure.core.pipeline.transport import AioHttpTransport
+
+        jobs = self._prepare(output_dir, filepaths, container_name)
+
+        # aiohttp allows 100 connections by default, raise it like the requests pool in _create_transport
+        # (the other options are the ones the azure transport would otherwise create its session with,
+        # trust_env so proxies from HTTP(S)_PROXY are used like in the requests session)
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.connection_pool_size),
+            cookie_jar=aiohttp.DummyCookieJar(),
+            auto_decompress=False,
+            trust_env=True,
+        )
+        transport = AioHttpTransport(session=session)
+
+        try:
+            blob_service_client = AsyncBlobServiceClient.from_connection_string(self.key, transport=transport)
+        except Exception:
+            # the session is closed along with the client, which wasn't created
+            await session.close()
+            raise
+
+        async with blob_service_client:
+            container_clients = {name: blob_service_client.get_container_client(name) for name in {job[2] for job in jobs}}
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            async def download_one(fpath, tpath, c, output_path):
+                async with semaphore:
+                    return await self._download_one_async(container_clients[c], fpath, tpath, output_path)
+
+            tasks = [
+                asyncio.ensure_future(download_one(fpath, tpath, c, output_path))
+                for fpath, tpath, c, output_path, _ in jobs
+            ]
+
+            # wait for the results in the order the paths were given, like the futures in download
+            results = []
+            error = None
+            try:
+                for task in tasks:
+                    results.append(await task)
+            except Exception as e:
+                error = e
+            finally:
+                # don't continue the remaining downloads if one of them raised
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+        def unwrap():
+            yield from results
+            if error is not None:
+                raise error
+
+        self._merge_results(jobs, unwrap())
 
 def main():
-    global log, DRY, RENAME
+    global log, SILENT, DRY, RENAME
     args = parser.parse_args()
 
     DRY = args.dry
     RENAME = not args.no_rename
 
-    if args.silent:
+    SILENT = args.silent
+    if SILENT:
         log = lambda *a, **kw: None
 
     connect_str = args.key or os.getenv(ENV_KEY, '')
@@ -205,15 +583,23 @@ def main():
         if args.file.lower().endswith(".csv"):
             with open(args.file, 'r', encoding='utf-8') as f:
                 reader = csv.reader(f, delimiter=args.delimiter)
-                for row in reader:
-                    filepaths.append(row[0].strip())
+                # skip empty rows, they have no first column
+                filepaths.extend(row[0].strip() for row in reader if row)
         else:
             with open(args.file, 'r', encoding='utf-8') as f:
-                for p in f.readlines():
-                    filepaths.append(p.strip())
-
-    downloader = AzureDownloader(connect_str)
-    downloader.download(args.output, filepaths, container_name=args.container)
+                filepaths.extend(line.strip() for line in f)
+
+    # the same path may be given more than once, only download it once
+    path_count = len(filepaths)
+    filepaths = list(dict.fromkeys(filepaths))
+    if len(filepaths) < path_count:
+        log(f"Ignoring {path_count - len(filepaths)} duplicate file paths")
+
+    downloader = AzureDownloader(connect_str, concurrency=args.concurrency, blob_concurrency=args.blob_concurrency, retries=args.retries)
+    if args.use_async:
+        asyncio.run(downloader.download_async(args.output, filepaths, container_name=args.container))
+    else:
+        downloader.download(args.output, filepaths, container_name=args.container)
 
 if __name__ == '__main__':
     main()